@@ -28,8 +28,6 @@
  along with OpenShot Library.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import weakref
-
 
 class GraphNode:
     """A node for the `Graph` class.
@@ -40,18 +38,23 @@ class GraphNode:
 
     A GraphNode can also be used as a key in a dictionary, because it is *hashable*.
     Each instance is considered a different node.
+
+    Once added to a `Graph`, `node.idx` is the node's index in that graph.
     """
+    __slots__ = ('data', 'idx', '_pyority', '__weakref__')
 
     def __init__(self, data):
         self.data = data
+        self.idx = -1
+        # The `data.pyority` method is looked up only once.
+        self._pyority = getattr(data, 'pyority', None)
 
     def pyority(self):
         """Uses this node's data *pyority* if available.
         Otherwise, returns zero.
         """
-        method = getattr(self.data, 'pyority', None)
-        if method is not None:
-            val = method()
+        if self._pyority is not None:
+            val = self._pyority()
             assert val >= 0
             return val
         return 0.0
@@ -66,6 +69,7 @@ class TaskStart(GraphNode):
     They are created in pairs and the *start* `node`
     knows its corresponing `node.end`.
     """
+    __slots__ = ('_end',)
     is_start = True
     is_end = False
 
@@ -78,14 +82,14 @@ class TaskStart(GraphNode):
         """Returns the associated *end node*."""
         if self._end is None:
             raise Exception("No 'end node' associated to TaskStart.")
-        return self._end()
+        return self._end
 
     @end.setter
     def end(self, end):
         """Sets the corresponging *end node*. This can be done only once."""
         if self._end is not None:
             raise Exception("Cannot associate 'end node' twice.")
-        self._end = weakref.ref(end)
+        self._end = end
 
     def __str__(self):
         return f"Start: {self.data}"
@@ -96,6 +100,7 @@ class TaskEnd(GraphNode):
     They are created in pairs and the *end* `node`
     knows its corresponing `node.start`.
     """
+    __slots__ = ('_start',)
     is_start = False
     is_end = True
 
@@ -108,14 +113,14 @@ class TaskEnd(GraphNode):
         """Returns the associated *end node*."""
         if self._start is None:
             raise Exception("No 'start node' associated to TaskStart.")
-        return self._start()
+        return self._start
 
     @start.setter
     def start(self, start):
         """Sets the corresponging *start node*. This can be done only once."""
         if self._start is not None:
             raise Exception("Cannot associate 'start node' twice.")
-        self._start = weakref.ref(start)
+        self._start = start
 
     def pyority(self):
         return 0.0
@@ -24,12 +24,86 @@
  along with OpenShot Library.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import heapq
+from array import array
+
 import numpy as np
-from scipy.sparse import dok_array, identity
+from scipy.sparse import coo_array, csr_array
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 from pyority.nodes import TaskStart, TaskEnd, TaskNodePair
 
 
+def _topological_order(indptr, indices):
+    """Kahn's algorithm over a CSR adjacency,
+    where row `u` lists the nodes that directly depend on `u`.
+
+    Returns the nodes in an order where every node comes after
+    the nodes it depends on.  Nodes that are part of a cycle
+    (or that depend on one) are left out.
+    """
+    n = len(indptr) - 1
+    in_degree = np.bincount(indices, minlength=n).tolist()
+    indptr = indptr.tolist()
+    indices = indices.tolist()
+    order = [v for v in range(n) if in_degree[v] == 0]
+    for u in order:
+        for v in indices[indptr[u]:indptr[u + 1]]:
+            in_degree[v] -= 1
+            if in_degree[v] == 0:
+                order.append(v)
+    return np.array(order, dtype=np.int32)
+
+
+def _propagate(indptr, indices, order, reach):
+    """For each node `v` in `order`, sets bit `v` of the bitset row `reach[v]`
+    (every node reaches itself) and ORs into it the rows of the nodes
+    that directly depend on `v`.
+    The dependents of `v` are expected to be processed before `v`.
+    """
+    for v in order:
+        reach[v, v >> 6] |= np.uint64(1) << np.uint64(v & 63)
+        dependents = indices[indptr[v]:indptr[v + 1]]
+        if len(dependents):
+            reach[v] |= np.bitwise_or.reduce(reach[dependents], axis=0)
+
+
+if njit is not None:
+    # Same as above, compiled when this module is imported.
+    @njit('void(i4[::1], i4[::1], i4[::1], u8[:, ::1])', cache=True, boundscheck=False)
+    def _propagate(indptr, indices, order, reach):
+        for k in range(order.shape[0]):
+            v = order[k]
+            reach[v, v >> 6] |= np.uint64(1) << np.uint64(v & 63)
+            for p in range(indptr[v], indptr[v + 1]):
+                w = indices[p]
+                for b in range(reach.shape[1]):
+                    reach[v, b] |= reach[w, b]
+
+
+def _bitset_to_csr(reach, n):
+    """Converts bitset rows (as `np.uint64` words) into a boolean `csr_array`.
+    Only the nonzero words are unpacked, so the cost follows the number
+    of nonzero words, and not the `n x n` size of the bitset.
+    """
+    rows, words = np.nonzero(reach)
+    packed = reach[rows, words].astype('<u8').view(np.uint8).reshape(-1, 8)
+    bits = np.unpackbits(packed, axis=1, bitorder='little')
+    # `np.nonzero` goes row by row, so rows stay sorted,
+    # and so do the columns within each row.
+    word_pos, bit = np.nonzero(bits)
+    rows = rows[word_pos]
+    indices = words[word_pos] * 64 + bit
+    indptr = np.zeros(n + 1, dtype=np.intp)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    data = np.ones(len(indices), dtype=np.bool_)
+    return csr_array((data, indices, indptr), shape=(n, n))
+
+
 class Graph:
     """A graph of nodes, representing their dependency relation.
 
@@ -57,94 +131,264 @@ class Graph:
     """
 
     def __init__(self):
-        self._dirty = True
+        self._direct_dirty = True
+        self._topology_dirty = True
+        self._pyority_dirty = True
         self.idx_to_node = []
-        self.node_to_idx = {}
-        self.direct_dependencies = dok_array((128, 128), dtype=np.bool_)
-        self.individual_pyorities = dok_array((128, 1), dtype=np.half)
+        self._dep_rows = array('i')
+        self._dep_cols = array('i')
+        # While each node directly depends on at most one node (its *parent*),
+        # the graph is a forest, and the closure is cheaper to compute.
+        self._parents = array('i')
+        self._is_tree = True
+        # Zero-filled, and doubled in size when full.
+        self._pyorities = np.zeros(128, dtype=np.float32)
+        self.direct_dependencies = None
         self.full_dependency_rows = None
-        self.full_dependency_cols = None
+        self._deps_cache = {}
+        self._heap = None
 
     def prepare(self):
-        """Makes sure the computed data is up to date."""
-        if not self._dirty:
-            return
-        self._set_full_dependency_matrices()
-        self._set_full_pyorities()
-        self._dirty = False
+        """Makes sure the computed data is up to date.
+        The transitive closure is only recomputed when
+        nodes or dependencies were added.
+        """
+        if self._topology_dirty:
+            self._prepare_direct_dependencies()
+            self._set_full_dependency_matrices()
+            self._deps_cache = {}
+            self._pyority_dirty = True
+            self._topology_dirty = False
+        if self._pyority_dirty:
+            self._set_full_pyorities()
+            self._pyority_dirty = False
+
+    def _prepare_direct_dependencies(self):
+        """Makes sure `direct_dependencies` is up to date,
+        without computing the transitive closure.
+        """
+        if self._direct_dirty:
+            self._set_direct_dependency_matrix()
+            self._direct_dirty = False
 
     @property
     def n_nodes(self):
         """Number of nodes in this graph."""
         return len(self.idx_to_node)
 
+    def _idx(self, node):
+        """The index of `node` in this graph.
+        Raises `KeyError` if `node` was not added to this graph.
+        """
+        idx = node.idx
+        if not (0 <= idx < self.n_nodes and self.idx_to_node[idx] is node):
+            raise KeyError(node)
+        return idx
+
     def add_node(self, node):
         """Adds a new node to the graph."""
-        self._dirty = True
-        idx = len(self.idx_to_node)
-        self.idx_to_node.append(node)
-        self.node_to_idx[node] = idx
-        assert len(self.node_to_idx) == len(self.idx_to_node)
-        # Resize matrix if needed
-        size = self.direct_dependencies.shape[0]
-        while size < self.n_nodes:
-            size <<= 1
-        self.direct_dependencies.resize(size, size)
-        self.individual_pyorities.resize(1, size)
-        self.individual_pyorities[0, idx] = node.pyority()
+        self.add_nodes((node,))
+
+    def add_nodes(self, nodes):
+        """Adds new nodes to the graph, all at once."""
+        first_idx = len(self.idx_to_node)
+        for idx, node in enumerate(nodes, first_idx):
+            assert node.idx < 0, "Node already belongs to a graph."
+            node.idx = idx
+            self.idx_to_node.append(node)
+        if first_idx == len(self.idx_to_node):
+            return
+        self._direct_dirty = True
+        self._topology_dirty = True
+        self._parents.extend(array('i', [-1]) * (self.n_nodes - first_idx))
+        size = len(self._pyorities)
+        if size < self.n_nodes:
+            while size < self.n_nodes:
+                size <<= 1
+            pyorities = np.zeros(size, dtype=np.float32)
+            pyorities[:first_idx] = self._pyorities[:first_idx]
+            self._pyorities = pyorities
+        for node in self.idx_to_node[first_idx:]:
+            # Half of the nodes are usually *ends*, and their *pyority* is zero.
+            # Unless some subclass overrides `TaskEnd.pyority()`.
+            if type(node).pyority is not TaskEnd.pyority:
+                pyority = node.pyority()
+                assert pyority >= 0
+                if pyority:
+                    self._pyorities[node.idx] = pyority
 
     def add_node_dependency(self, this, depends_on_that):
         """Imposes that `this` node `depends_on_that` node."""
-        assert this != depends_on_that
-        self._dirty = True
-        this_idx = self.node_to_idx[this]
-        depends_idx = self.node_to_idx[depends_on_that]
-        assert this_idx != depends_idx
-        self.direct_dependencies[depends_idx, this_idx] = True
+        self.add_node_dependencies(((this, depends_on_that),))
+
+    def add_node_dependencies(self, dependencies):
+        """Imposes, for each pair `(this, depends_on_that)` in `dependencies`,
+        that `this` node `depends_on_that` node.
+        """
+        n_edges = len(self._dep_rows)
+        for this, depends_on_that in dependencies:
+            this_idx = self._idx(this)
+            depends_idx = self._idx(depends_on_that)
+            assert this_idx != depends_idx
+            self._dep_rows.append(depends_idx)
+            self._dep_cols.append(this_idx)
+            if self._is_tree:
+                parent = self._parents[this_idx]
+                if parent < 0:
+                    self._parents[this_idx] = depends_idx
+                elif parent != depends_idx:
+                    self._is_tree = False
+        if n_edges != len(self._dep_rows):
+            self._direct_dirty = True
+            self._topology_dirty = True
+
+    def set_pyority(self, node, pyority):
+        """Replaces the *pyority* of `node`.
+        By default, it is the value returned by `node.pyority()`
+        when the node was added.
+
+        Changing *pyorities* does not change the dependencies,
+        so the transitive closure is not recomputed.
+        """
+        idx = self._idx(node)
+        assert pyority >= 0
+        self._pyority_dirty = True
+        self._pyorities[idx] = pyority
 
     def nodes_i_depend_on(self, node):
         """The set of nodes `node` **directly** depends on."""
-        col = self.direct_dependencies[:, [self.node_to_idx[node]]]
+        self._prepare_direct_dependencies()
+        col = self.direct_dependencies[:, [self._idx(node)]]
         return {self.idx_to_node[i] for i in col.nonzero()[0]}
 
     def nodes_i_fully_depend_on(self, node):
-        """The set of nodes `node` depends on. Directly or not."""
-        idx = self.node_to_idx[node]
-        col = self.full_dependency_cols[:, [idx]]
-        return {self.idx_to_node[i] for i in col.nonzero()[0] if i != idx}
+        """The set of nodes `node` depends on. Directly or not.
+        Results are cached until the dependencies change.
+        """
+        self.prepare()
+        idx = self._idx(node)
+        deps = self._deps_cache.get(idx)
+        if deps is None:
+            # Only the CSR form of the closure is kept. Column slicing is slower,
+            # but it does not need a second (CSC) copy of the whole closure.
+            col = self.full_dependency_rows[:, [idx]]
+            deps = frozenset(self.idx_to_node[i] for i in col.nonzero()[0] if i != idx)
+            self._deps_cache[idx] = deps
+        return set(deps)
+
+    def _set_direct_dependency_matrix(self):
+        """Builds the *direct* dependency matrix from the recorded edges.
+        Edges are only buffered when added, and the sparse matrix
+        is assembled here, at once.
+        """
+        n = self.n_nodes
+        data = np.ones(len(self._dep_rows), dtype=np.bool_)
+        M = coo_array((data, (self._dep_rows, self._dep_cols)), shape=(n, n))
+        self.direct_dependencies = M.tocsr()
 
     def _set_full_dependency_matrices(self):
-        """Computes the xxxx."""
-        self.direct_dependencies.resize(self.n_nodes, self.n_nodes)
-        Id = identity(self.n_nodes, dtype=np.bool_)
-        M = (self.direct_dependencies + Id).tocsr()
-        nnz = 0
-        next_nnz = M.nnz
-        while nnz != next_nnz:
-            M = M @ M
-            nnz = next_nnz
-            next_nnz = M.nnz
-        self.full_dependency_rows = M.tocsr()
-        self.full_dependency_cols = M.tocsc()
+        """Computes the transitive closure of the direct dependencies.
+
+        Row `i` of the closure is the set of nodes that depend on node `i`
+        (including `i` itself).  Instead of squaring the adjacency matrix
+        until it stabilizes, we sort the nodes topologically and walk them
+        backwards, so each node's row is the union of its dependents' rows.
+        Rows are kept as bitsets of `np.uint64` words while propagating.
+        """
+        if self._is_tree:
+            closure = self._tree_closure()
+            if closure is not None:
+                self.full_dependency_rows = closure
+                return
+
+        n = self.n_nodes
+        direct = self.direct_dependencies
+        indptr = direct.indptr.astype(np.int32, copy=False)
+        indices = direct.indices.astype(np.int32, copy=False)
+        order = _topological_order(indptr, indices)
+
+        reach = np.zeros((n, (n + 63) >> 6), dtype=np.uint64)
+        nodes = np.arange(n, dtype=np.int32)
+
+        # Nodes left out of the topological order are in (or depend on) a cycle.
+        # Their dependents are left out, too. So, we settle them first.
+        cyclic = np.setdiff1d(nodes, order, assume_unique=True)
+        changed = len(cyclic) > 0
+        while changed:
+            before = reach[cyclic]
+            _propagate(indptr, indices, cyclic, reach)
+            changed = not np.array_equal(before, reach[cyclic])
+        _propagate(indptr, indices, np.ascontiguousarray(order[::-1]), reach)
+
+        self.full_dependency_rows = _bitset_to_csr(reach, n)
+
+    def _tree_closure(self):
+        """The transitive closure when the graph is a forest.
+
+        Then, the nodes that depend on `i` are the ones having `i` as an
+        ancestor.  All parent chains are walked together, one level at a
+        time, and the closure is assembled directly as a sparse matrix.
+        Returns `None` if the parent chains have a cycle.
+        """
+        n = self.n_nodes
+        parents = np.array(self._parents, dtype=np.int32)
+        nodes = np.arange(n, dtype=np.int32)
+        rows = [nodes]
+        cols = [nodes]
+        ancestors = parents
+        for _ in range(n + 1):
+            has_ancestor = ancestors >= 0
+            nodes = nodes[has_ancestor]
+            ancestors = ancestors[has_ancestor]
+            if not len(nodes):
+                break
+            rows.append(ancestors)
+            cols.append(nodes)
+            ancestors = parents[ancestors]
+        else:
+            return None
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        data = np.ones(len(rows), dtype=np.bool_)
+        return coo_array((data, (rows, cols)), shape=(n, n)).tocsr()
 
     def _set_full_pyorities(self):
         """Precomputes the *full pyority*.
         That is, it associates to each node the sum of its *pyority*
         and the *pyorities* for all nodes that depend on it.
         """
-        self.individual_pyorities.resize(1, self.n_nodes)
         MR = self.full_dependency_rows
-        MC = self.full_dependency_cols
-        individual_pyorities = self.individual_pyorities.tocsr()
-        assert all(
-            self.individual_pyorities[i, j] >= 0.0
-            for i, j in zip(*self.individual_pyorities.nonzero())
-        )
-        self.full_pyorities = (individual_pyorities @ MC).toarray()[0]
-        fp_nnz_idx = sorted(
-            (-fp, -MR[[i]].nnz, i) for (i, fp) in enumerate(self.full_pyorities)
-        )
-        self.order = [self.idx_to_node[fni[2]] for fni in fp_nnz_idx]
+        individual_pyorities = self._pyorities[:self.n_nodes]
+        # Row `i` of the closure lists `i` and the nodes that depend on it.
+        # No row is empty, so `reduceat` sums exactly one row per node.
+        # This is just a sum, so no diamond is ever counted twice.
+        row_starts = MR.indptr[:-1]
+        if len(row_starts):
+            self.full_pyorities = np.add.reduceat(
+                individual_pyorities[MR.indices], row_starts)
+        else:
+            self.full_pyorities = individual_pyorities.copy()
+        # Number of nodes that depend on each node (itself included).
+        self.full_dependency_counts = np.diff(MR.indptr)
+        # The iteration heap is only built when the nodes are iterated.
+        self._heap = None
+
+    def _set_heap(self):
+        """Builds the heap `__iter__` pops nodes from.
+        Greater *full pyority* first. Then, more dependent nodes first.
+        Remaining ties are ordered by index.
+
+        A heap is built in linear time, and `__iter__` only pays
+        for the nodes that are actually consumed.
+        Keys are built from whole arrays with `tolist()`, so the heap compares
+        plain Python numbers, not NumPy scalars boxed one at a time.
+        """
+        self._heap = list(zip(
+            (-self.full_pyorities).tolist(),
+            (-self.full_dependency_counts).tolist(),
+            range(self.n_nodes),
+        ))
+        heapq.heapify(self._heap)
 
     def __iter__(self):
         """Iterates through all nodes in a way consistent with their dependencies.
@@ -152,7 +396,11 @@ class Graph:
         Nodes with greater *full pyority* are iterated first.
         """
         self.prepare()
-        yield from self.order
+        if self._heap is None:
+            self._set_heap()
+        heap = list(self._heap)
+        while heap:
+            yield self.idx_to_node[heapq.heappop(heap)[2]]
 
 
 class Scheduler(Graph):
@@ -169,6 +417,12 @@ class Scheduler(Graph):
         if task_end is not None:
             self._TaskEnd = task_end
 
+    def _new_pair(self, task):
+        """Creates the *start* and *end* nodes for `task`,
+        without adding them to the graph.
+        """
+        return TaskNodePair(self._TaskStart(task), self._TaskEnd(task))
+
     def add_task(self, task, *subtasks):
         """A task has two nodes (*start* and *end*).
         To finish a task one needs to begin. So, *end* depends on *start*.
@@ -183,9 +437,8 @@ class Scheduler(Graph):
             scheduler.add_subtasks(pair, sub1, sub2, sub3)
             ```
         """
-        pair = TaskNodePair(self._TaskStart(task), self._TaskEnd(task))
-        self.add_node(pair.start)
-        self.add_node(pair.end)
+        pair = self._new_pair(task)
+        self.add_nodes((pair.start, pair.end))
         self.add_node_dependency(pair.end, pair.start)
         if subtasks:
             self.add_subtasks(pair, *subtasks)
@@ -193,12 +446,24 @@ class Scheduler(Graph):
 
     def add_subtasks(self, parent_pair, *subtasks):
         """A subtask is a pair of nodes whose *start* depends on its parent's *start*;
-        and such that the parent's *end* depends on the subtask's *end*."""
-        for task in subtasks:
-            new_pair = self.add_task(task)
-            self.add_node_dependency(new_pair.start, parent_pair.start)
-            self.add_node_dependency(parent_pair.end, new_pair.end)
-            parent_pair.register_subtask(new_pair)
+        and such that the parent's *end* depends on the subtask's *end*.
+
+        All pairs are created first, and then their nodes and dependencies
+        are added to the graph in one go.  So, this does not call `add_task()`.
+        Both create their pairs through `_new_pair()`, though.
+        """
+        new_pairs = [self._new_pair(task) for task in subtasks]
+        self.add_nodes(
+            node for pair in new_pairs for node in (pair.start, pair.end)
+        )
+        self.add_node_dependencies(
+            dependency for pair in new_pairs for dependency in (
+                (pair.end, pair.start),
+                (pair.start, parent_pair.start),
+                (parent_pair.end, pair.end),
+            )
+        )
+        parent_pair.register_subtasks(*new_pairs)
 
     def add_task_dependency(self, this, depends_on_that):
         """The *start* of `this` `depends_on_that`'s *end*."""